@@ -1,4 +1,4 @@
-file: wechat_work_email_plugin.py
+# file: wechat_work_email_plugin.py
 
 """
 微信企业邮箱管理插件
@@ -13,8 +13,15 @@ file: wechat_work_email_plugin.py
 """
 
 import imaplib
+import re
 import smtplib
-import email
+import threading
+import time
+from email.header import decode_header
+from email.parser import BytesParser
+from email.policy import compat32
+from email import encoders
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime, timedelta
@@ -28,11 +35,27 @@ from app.plugins import _PluginBase
 from app.log import logger
 from app.schemas import NotificationType
 
+# 邮件列表仅需的头部字段，以及用于生成正文预览的开头片段
+# 500个中文字符经UTF-8与base64编码约2000字节，加上multipart分段头，取4096字节
+PREVIEW_FETCH_ITEMS = (
+    '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE CONTENT-TYPE CONTENT-TRANSFER-ENCODING)]'
+    ' BODY.PEEK[TEXT]<0.4096>)'
+)
+# 复用解析器实例，解析器本身无状态，可跨线程共享
+MESSAGE_PARSER = BytesParser(policy=compat32)
+# 邮件服务器套接字超时（秒），长连接被静默断开时尽快失败并重连
+SOCKET_TIMEOUT = 30
+# 最近邮件缓存的最长有效期（秒），超过后打开页面时同步刷新
+CACHE_MAX_AGE = 30 * 60
+# FETCH响应中的UID数据项
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+
+
 class WeWorkEmail(_PluginBase):
     plugin_name = "微信企业邮箱管理"
     plugin_desc = "可视化收发微信企业邮箱邮件，支持附件管理"
     plugin_icon = "https://example.com/email_icon.png"
-    plugin_version = "1.0.0"
+    plugin_version = "1.1"
     plugin_author = "[时也命也]"
     author_url = "https://github.com/beijingxiaokuoe"
     plugin_config_prefix = "wework_email_"
@@ -48,8 +71,35 @@ class WeWorkEmail(_PluginBase):
     _check_interval = "*/10 * * * *"  # 默认10分钟检查一次
     _notify = True
     _scheduler: Optional[BackgroundScheduler] = None
+    # 长连接复用，避免每次操作重复TLS握手与登录
+    _imap: Optional[imaplib.IMAP4_SSL] = None
+    _smtp: Optional[smtplib.SMTP_SSL] = None
+    _imap_lock: Optional[threading.Lock] = None
+    _smtp_lock: Optional[threading.Lock] = None
+    # 最近邮件缓存，由定时任务刷新，页面渲染直接读取
+    _cached_emails: List[dict] = []
+    _cache_ts: float = 0
+    _last_config: Optional[tuple] = None
 
     def init_plugin(self, config: dict = None):
+        # 锁为实例级状态，只创建一次，避免替换正被其他线程持有的锁
+        if not self._imap_lock:
+            self._imap_lock = threading.Lock()
+        if not self._smtp_lock:
+            self._smtp_lock = threading.Lock()
+
+        if config:
+            # 影响服务的配置未变化且服务运行中时，无需重建调度器
+            service_config = (
+                config.get("enabled"),
+                config.get("account"),
+                config.get("password"),
+                config.get("check_interval", "*/10 * * * *")
+            )
+            if service_config == self._last_config and self._scheduler:
+                return
+            self._last_config = service_config
+
         self.stop_service()
 
         if config:
@@ -63,7 +113,20 @@ class WeWorkEmail(_PluginBase):
             self._scheduler.add_job(
                 self.check_email,
                 trigger=CronTrigger.from_crontab(self._check_interval),
-                id="wework_email_check"
+                id="wework_email_check",
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
+            )
+            # 定时NOOP保活，防止服务端30分钟空闲断开
+            self._scheduler.add_job(
+                self._keepalive,
+                trigger="interval",
+                minutes=25,
+                id="wework_email_keepalive",
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
             )
             self._scheduler.start()
             logger.info("微信企业邮箱插件已启动")
@@ -75,23 +138,101 @@ class WeWorkEmail(_PluginBase):
             return False
         return True
 
+    def _get_imap(self) -> imaplib.IMAP4_SSL:
+        """获取IMAP连接，连接失效时自动重连，调用方需持有_imap_lock"""
+        if self._imap:
+            try:
+                self._imap.noop()
+                return self._imap
+            except (imaplib.IMAP4.error, OSError):
+                self._close_imap()
+        imap = imaplib.IMAP4_SSL(self._imap_host, timeout=SOCKET_TIMEOUT)
+        imap.login(self._account, self._password)
+        self._imap = imap
+        return imap
+
+    def _close_imap(self):
+        """关闭IMAP连接"""
+        if self._imap:
+            try:
+                self._imap.logout()
+            except Exception:
+                pass
+            self._imap = None
+
+    def _get_smtp(self) -> smtplib.SMTP_SSL:
+        """获取SMTP连接，连接失效时自动重连，调用方需持有_smtp_lock"""
+        if self._smtp:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close_smtp()
+        smtp = smtplib.SMTP_SSL(self._smtp_host, timeout=SOCKET_TIMEOUT)
+        smtp.login(self._account, self._password)
+        self._smtp = smtp
+        return smtp
+
+    def _close_smtp(self):
+        """关闭SMTP连接"""
+        if self._smtp:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _keepalive(self):
+        """IMAP连接保活"""
+        with self._imap_lock:
+            if self._imap:
+                try:
+                    self._imap.noop()
+                except (imaplib.IMAP4.error, OSError):
+                    self._close_imap()
+
     def check_email(self):
         """检查新邮件"""
-        try:
-            with imaplib.IMAP4_SSL(self._imap_host) as imap:
-                imap.login(self._account, self._password)
+        with self._imap_lock:
+            try:
+                imap = self._get_imap()
                 imap.select("INBOX")
+                # 账号变更或UIDVALIDITY变化说明UID已不可比较，需从头检查
+                uidvalidity = (imap.response('UIDVALIDITY')[1][0] or b'').decode()
+                uid_state = self.get_data("uid_state") or {}
+                if uid_state.get("account") == self._account and uid_state.get("uidvalidity") == uidvalidity:
+                    last_uid = uid_state.get("last_uid", 0)
+                else:
+                    last_uid = 0
 
-                status, messages = imap.search(None, 'UNSEEN')
+                # 仅搜索上次检查之后到达的邮件，避免服务端扫描整个邮箱
+                status, messages = imap.uid('SEARCH', None, f'UID {last_uid + 1}:* UNSEEN')
                 if status == 'OK':
-                    email_count = len(messages[0].split())
-                    if email_count > 0:
+                    # "n:*"在n大于最大UID时仍会返回最后一封邮件，需在本地过滤
+                    uids = [int(uid) for uid in messages[0].split() if int(uid) > last_uid]
+                    if uids:
                         self._send_notification(
                             title="📬 新邮件通知",
-                            text=f"检测到 {email_count} 封未读邮件"
+                            text=f"检测到 {len(uids)} 封新的未读邮件"
                         )
-        except Exception as e:
-            logger.error(f"检查邮件失败: {str(e)}")
+                        self.save_data("uid_state", {
+                            "account": self._account,
+                            "uidvalidity": uidvalidity,
+                            "last_uid": max(uids)
+                        })
+            except Exception as e:
+                logger.error(f"检查邮件失败: {str(e)}")
+                self._close_imap()
+        self._refresh_recent_emails()
+
+    def _refresh_recent_emails(self):
+        """刷新最近邮件缓存，获取失败时保留原有缓存"""
+        emails = self.get_recent_emails()
+        if emails is None:
+            return
+        self._cached_emails = emails
+        self._cache_ts = time.time()
 
     def send_email(self, to: str, subject: str, content: str, attachments: list = None) -> dict:
         """发送邮件"""
@@ -105,7 +246,13 @@ class WeWorkEmail(_PluginBase):
             # 附件处理
             if attachments:
                 for file in attachments:
-                    part = MIMEText(file['content'])
+                    # 附件统一按二进制处理，单次base64编码
+                    payload = file['content']
+                    if isinstance(payload, str):
+                        payload = payload.encode('utf-8')
+                    part = MIMEBase('application', 'octet-stream')
+                    part.set_payload(payload)
+                    encoders.encode_base64(part)
                     part.add_header(
                         'Content-Disposition',
                         'attachment',
@@ -113,53 +260,122 @@ class WeWorkEmail(_PluginBase):
                     )
                     msg.attach(part)
 
-            with smtplib.SMTP_SSL(self._smtp_host) as smtp:
-                smtp.login(self._account, self._password)
-                smtp.send_message(msg)
+            with self._smtp_lock:
+                try:
+                    self._get_smtp().send_message(msg)
+                except Exception:
+                    self._close_smtp()
+                    raise
             
             return {"status": True, "message": "邮件发送成功"}
         except Exception as e:
             logger.error(f"邮件发送失败: {str(e)}")
             return {"status": False, "message": str(e)}
 
-    def get_recent_emails(self, limit=20) -> List[dict]:
-        """获取最近邮件"""
+    def get_recent_emails(self, limit=20) -> Optional[List[dict]]:
+        """获取最近邮件，失败时返回None"""
         emails = []
-        try:
-            with imaplib.IMAP4_SSL(self._imap_host) as imap:
-                imap.login(self._account, self._password)
+        with self._imap_lock:
+            try:
+                imap = self._get_imap()
                 imap.select("INBOX")
 
-                status, messages = imap.search(None, 'ALL')
+                # 使用UID而非序号，避免SEARCH与FETCH之间的EXPUNGE导致错位
+                status, messages = imap.uid('SEARCH', None, 'ALL')
                 if status == 'OK':
-                    for num in messages[0].split()[:limit]:
-                        status, data = imap.fetch(num, '(RFC822)')
-                        if status == 'OK':
-                            raw_email = data[0][1]
-                            email_message = email.message_from_bytes(raw_email)
-                            
+                    uids = messages[0].split()[:limit]
+                    if not uids:
+                        return emails
+                    # 单次批量拉取头部与正文开头片段，不下载完整邮件及附件
+                    status, data = imap.uid('FETCH', b','.join(uids), PREVIEW_FETCH_ITEMS)
+                    if status == 'OK':
+                        parts = self._group_fetch_parts(data)
+                        for uid in uids:
+                            part = parts.get(uid)
+                            if not part:
+                                continue
+                            raw_email = part.get('header', b'') + part.get('text', b'')
+                            email_message = MESSAGE_PARSER.parsebytes(raw_email)
+
                             email_info = {
-                                'from': email_message['From'],
-                                'subject': email_message['Subject'],
+                                'from': self._decode_header(email_message['From']),
+                                'subject': self._decode_header(email_message['Subject']),
                                 'date': email_message['Date'],
                                 'content': self._parse_email_content(email_message)
                             }
                             emails.append(email_info)
-        except Exception as e:
-            logger.error(f"获取邮件失败: {str(e)}")
+            except Exception as e:
+                logger.error(f"获取邮件失败: {str(e)}")
+                self._close_imap()
+                return None
         return emails
 
+    @staticmethod
+    def _group_fetch_parts(data: list) -> Dict[bytes, Dict[str, bytes]]:
+        """将批量UID FETCH响应按UID归组为头部与正文片段"""
+        messages = []
+        current = None
+        for item in data:
+            # 邮件在SEARCH与FETCH之间全部被删除时，imaplib返回[None]
+            if not item:
+                continue
+            prefix = item[0] if isinstance(item, tuple) else item
+            # 每封邮件的首个片段以序号开头，后续片段以空格或右括号开头
+            if prefix[:1].isdigit():
+                current = {}
+                messages.append(current)
+            if current is None:
+                continue
+            # 服务端可能把UID放在任意数据项位置，包括最后的非literal片段
+            match = FETCH_UID_RE.search(prefix)
+            if match:
+                current['uid'] = match.group(1)
+            if isinstance(item, tuple):
+                section = 'header' if b'HEADER' in prefix.upper() else 'text'
+                current[section] = item[1]
+        return {message['uid']: message for message in messages if 'uid' in message}
+
+    @staticmethod
+    def _decode_header(header: Optional[str]) -> str:
+        """解码RFC 2047编码的邮件头，拼接所有编码片段"""
+        if not header:
+            return ""
+        decoded = []
+        for value, charset in decode_header(header):
+            if isinstance(value, str):
+                decoded.append(value)
+                continue
+            try:
+                decoded.append(value.decode(charset or "utf-8", errors="replace"))
+            except LookupError:
+                decoded.append(value.decode("utf-8", errors="replace"))
+        return "".join(decoded)
+
     def _parse_email_content(self, msg) -> str:
         """解析邮件内容"""
-        content = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/plain":
-                    content += part.get_payload(decode=True).decode()
-        else:
-            content = msg.get_payload(decode=True).decode()
-        return content[:500] + "..."  # 截取前500字符
+        content = []
+        remaining = 500  # 截取前500字符
+        # walk()对非multipart邮件只返回其自身，无需单独分支
+        parts = [part for part in msg.walk() if part.get_content_type() == "text/plain"]
+        if not parts:
+            # 没有纯文本部分时（如仅HTML的邮件）退回到首个text/*部分
+            parts = [part for part in msg.walk() if part.get_content_maintype() == "text"][:1]
+        for part in parts:
+            payload = part.get_payload(decode=True)
+            if payload is None:
+                continue
+            # 每字符最多4字节，只解码足够生成预览的部分
+            payload = payload[:remaining * 4]
+            charset = part.get_content_charset() or "utf-8"
+            try:
+                chunk = payload.decode(charset, errors="replace")[:remaining]
+            except LookupError:
+                chunk = payload.decode("utf-8", errors="replace")[:remaining]
+            content.append(chunk)
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+        return "".join(content) + "..."
 
     def _send_notification(self, title: str, text: str):
         """发送通知"""
@@ -237,7 +453,10 @@ class WeWorkEmail(_PluginBase):
 
     def get_page(self) -> List[dict]:
         """邮件列表页面"""
-        emails = self.get_recent_emails()
+        # 缓存未加载或已过期时同步刷新，其余情况由定时任务刷新
+        if time.time() - self._cache_ts > CACHE_MAX_AGE:
+            self._refresh_recent_emails()
+        emails = self._cached_emails
         rows = []
         for email in emails:
             rows.append({
@@ -302,3 +521,11 @@ class WeWorkEmail(_PluginBase):
             if self._scheduler.running:
                 self._scheduler.shutdown()
             self._scheduler = None
+        if self._imap_lock:
+            with self._imap_lock:
+                self._close_imap()
+        if self._smtp_lock:
+            with self._smtp_lock:
+                self._close_smtp()
+        self._cached_emails = []
+        self._cache_ts = 0